@@ -1,16 +1,48 @@
-import heapq
+import asyncio
 import enum
-from typing import List, Tuple, Dict, Optional
-from copy import deepcopy
-
-from pydantic import BaseModel
-
+from array import array
+from bisect import bisect_right
+from typing import List, Dict, Optional, Callable
+from copy import copy
+from dataclasses import dataclass, field, replace
+
+from pydantic import BaseModel, ConfigDict, Field, field_validator
+
+
+# Game phases and user roles as plain ints. Game logic stores and compares these, since they are
+# checked for every replayed request. Game.Phase and User.Role are for the outside world.
+PHASE_WAITING = 0
+PHASE_PLANNING = 1
+PHASE_SPRINT = 2
+PHASE_RETROSPECTIVE = 3
+
+# Game.State packs its phase and sprint count into one int: the phase in the low PHASE_BITS bits,
+# the sprint count above them.
+PHASE_BITS = 4
+PHASE_MASK = (1 << PHASE_BITS) - 1
+
+ROLE_USER = 1
+ROLE_LEADER = 2
+
+# Operations as int opcodes. A request's operation name is looked up in OP_CODE once when it comes
+# in, and the handler tables are keyed by these.
+OP_UNKNOWN = 0      # Not an operation, requests with these always get rejected.
+OP_START_GAME = 1
+OP_ADD_TOKEN = 2
+
+OP_CODE = {
+    "start_game": OP_START_GAME,
+    "add_token": OP_ADD_TOKEN,
+}
+_OP_NAMES = {name: name for name in OP_CODE}     # The one copy of every known operation name.
 
 class GameRequest(BaseModel):
     """
     Encapsulates a GameRequest. These Requests consist of GameOperations which most be done 
     atomically.
     """
+    model_config = ConfigDict(extra='forbid', frozen=True)
+
     user_id : int
     user_authcode : Optional[int] = None
     request_id : int
@@ -18,7 +50,18 @@ class GameRequest(BaseModel):
     operation_target : Optional[int] = None
     operation : str     # the operation or command to call
     operation_args : Dict         # arguments for the operation
-        
+
+    @field_validator('operation')
+    @classmethod
+    def _canonical_operation(cls, operation : str) -> str:
+        """
+        Requests with a known operation name all share one copy of it, so looking them up in
+        OP_CODE comes down to a pointer compare. Unknown names are left alone, they come from
+        clients and keeping them around would let anyone grow the server's memory.
+        """
+        return _OP_NAMES.get(operation, operation)
+
+
 # Note on target_ids: All user-alterable things in a game (ie. the Tasks, Chatbox, Noteboard) 
 # have a unique id assigned to them, and these ids are used in commands when referencing them.
 # Tasks start at id 1000. Everything else gets a constant predetermined value.
@@ -35,13 +78,39 @@ class GameRequest(BaseModel):
 # |     |                       |
 
 
+@dataclass(slots=True, frozen=True)
+class GameRequestInternal:
+    """
+    The form a GameRequest is kept in inside a Game. Requests get replayed over and over, so they
+    are converted once when they come in and from then on are read through plain slots instead of
+    pydantic models.
+    """
+    user_id : int
+    request_id : int
+    target_tick : int
+    operation_target : Optional[int]
+    operation : int     # the opcode of the operation
+    operation_args : Dict
+    source : GameRequest    # the validated request this was made from, sent back in GameUpdates.
+
+    @classmethod
+    def from_request(cls, request : GameRequest) -> 'GameRequestInternal':
+        """
+        Converts a validated GameRequest to its internal form.
+        """
+        return cls(request.user_id, request.request_id, request.target_tick, request.operation_target,
+                   OP_CODE.get(request.operation, OP_UNKNOWN), request.operation_args, request)
+
+
 class GameUpdate(BaseModel):
     """
     Sent by the Game to users to inform them of newly approved GameRequests, and if this decision
     invalidates any of the previously approved GRequests.
     """
-    new : Optional[List[GameRequest]] = []
-    invalidates : Optional[List[GameRequest]] = []
+    model_config = ConfigDict(extra='forbid', frozen=True)
+
+    new : List[GameRequest] = Field(default_factory=list)
+    invalidates : List[GameRequest] = Field(default_factory=list)
 
 
 class User:
@@ -52,13 +121,17 @@ class User:
         """
         Represents a User's in-game role.
         """
-        USER = 1
-        LEADER = 2
+        USER = ROLE_USER
+        LEADER = ROLE_LEADER
+
+    __slots__ = ('user_id', 'name', 'authcode', 'role', 'free_tokens')
 
     def __init__(self, user_id : int, username : str, authcode : int):
         self.user_id = user_id
         self.name = username
         self.authcode = authcode
+        self.role : int = ROLE_USER
+        self.free_tokens : int = 0  # tokens the user can still put on tasks.
 
 
 class GameObject:
@@ -66,12 +139,19 @@ class GameObject:
     Represents a in-game object.
 
     self.operations hold all available in-game operations.
-    The signature for an operation should be (self, state: GameState, request : GameRequest) -> GameState
-    It returns either the next GameState or None if operation violates in-game rules.
+    The signature for an operation should be (self, state: GameState, request : GameRequest) -> GameObject
+    It returns either the object that replaces this one in the next GameState or None if operation
+    violates in-game rules. The Game puts the replacement in the next GameState.
+
+    An operation should only change its own object, and read nothing but that object and the users.
+    Game.make_request relies on this to reorder requests targeting different objects, and to apply
+    the ones of the same tick together.
     """
+    __slots__ = ('object_id', 'operations')
+
     def __init__(self, object_id):
         self.object_id : int = object_id
-        self.operations : dict [str, type(self.__init__)] = {}
+        self.operations : dict [int, type(self.__init__)] = {}
 
 
 
@@ -85,30 +165,63 @@ class Game:
         WAITING indicates game hasn't yet started.
         Rest are directly from the game specs.
         """
-        WAITING = 0
-        PLANNING = 1
-        SPRINT = 2
-        RETROSPECTIVE = 3
+        WAITING = PHASE_WAITING
+        PLANNING = PHASE_PLANNING
+        SPRINT = PHASE_SPRINT
+        RETROSPECTIVE = PHASE_RETROSPECTIVE
 
 
+    @dataclass(slots=True, eq=False)
     class State:
         """
         Represents the state of the game at a given tick.
 
         These go in between StateChanges so we don't need to rerender everything each time a
         request is made.
+
+        A State is never mutated once an operation returns it. Operations make the next State with
+        dataclasses.replace(), which only swaps the attributes they change, every other container
+        is shared with the previous State.
         """
-        def __init__(self):
-            self.objects : dict[int, GameObject] = {}
-            self.req_backlog : list[Task] = []
-            self.spr_backlog : list[Task] = []
-            self.game_phase : Game.Phase = Game.Phase.WAITING
-            self.sprint_count : int = 0
-            self.users : dict[int, User] = {}
+        objects : dict[int, GameObject] = field(default_factory=dict)
+        # Backlogs are keyed by task id and keep tasks in insertion order, so a task can be looked
+        # up or moved between them without scanning or shifting the rest.
+        req_backlog : 'dict[int, Task]' = field(default_factory=dict)
+        spr_backlog : 'dict[int, Task]' = field(default_factory=dict)
+        _phase_sprint : int = PHASE_WAITING    # game_phase | sprint_count << PHASE_BITS
+        users : dict[int, User] = field(default_factory=dict)
+
+        @property
+        def game_phase(self) -> int:
+            return self._phase_sprint & PHASE_MASK
+
+        @property
+        def sprint_count(self) -> int:
+            return self._phase_sprint >> PHASE_BITS
+
+    # A tick's State is only cached once this many requests have been replayed since the last
+    # cached one. Keeping a snapshot of every tick would cost more than replaying a few requests.
+    SNAPSHOT_INTERVAL = 8
+
+    __slots__ = ('_req_ticks', '_req_list', '_req_valid', '_tick_snapshots', 'state', '_head_state',
+                 '_auth', '_lock', 'operations')
 
     def __init__(self):
-        self.requests : dict[int, list[GameRequest]]
+        # Queued requests, flattened into parallel arrays sorted by tick. Requests of the same
+        # tick are kept in arrival order. Invalidated requests stay in place with valid unset.
+        self._req_ticks : array = array('q')
+        self._req_list : list[GameRequestInternal] = []
+        self._req_valid : bytearray = bytearray()
+        self._tick_snapshots : dict[int, Game.State] = {}   # State after each tick is applied.
         self.state = Game.State()
+        self._head_state = self.state   # State after every queued request is applied.
+        self._auth : set[tuple[int, int]] = set()   # (user_id, authcode) of every registered user.
+        self._lock = asyncio.Lock()     # Held while a request is being applied.
+        # The GameOperations concerning the game itself, by opcode. Bound once here so dispatching
+        # a request is a single dict lookup.
+        self.operations : dict[int, Callable[[Game.State, GameRequestInternal], Optional[Game.State]]] = {
+            OP_START_GAME: self._op_start_game,
+        }
 
     def add_user(self, user : User) -> None:
         """
@@ -116,80 +229,197 @@ class Game:
         """
 
         self.state.users[user.user_id] = user
+        self._auth.add((user.user_id, user.authcode))
+
+    def is_authorized(self, user_id : int, authcode : int) -> bool:
+        """
+        Returns whether the authcode belongs to the user with the given id.
+        """
+        return (user_id, authcode) in self._auth
 
 
-    def make_request(self, request : GameRequest) -> GameUpdate:
+    async def make_request(self, request : GameRequestInternal) -> GameUpdate:
         """
         Applies changes given in GameRequest. Returns a GameUpdate that should be sent out to users.
-        """
-        # Fuck it: just apply every request everytime a new request is made.
-        # FIXME This is absolute trash
-        result = GameUpdate()
-        current_state = deepcopy(self.state)
-        times = sorted(self.requests.keys())
-        time_i = 0
-        times_len = len(times)
-
-        while (time_i < times_len) and (times[time_i] > request.target_tick):
-            time = times[time_i]
-            if time > request.target_tick:
-                break
-            
-            for req in self.requests[time]:
-                current_state = self._apply_request(current_state, req)
-            # TODO Assert nonnull value
-
-            time_i = time_i + 1
 
-        current_state = self._apply_request(current_state, request)
+        The State after a queued tick is cached in self._tick_snapshots, so only the requests
+        after the target tick have to be replayed. Only every SNAPSHOT_INTERVAL'th replayed request
+        gets its tick cached, the ticks in between are replayed from an earlier snapshot when needed.
+
+        Requests to the same game are applied one at a time, long replays let other games run
+        in between.
+        """
+        async with self._lock:
+            return await self._make_request(request)
 
-        if current_state :
-            result.new.append(request)
+    async def _make_request(self, request : GameRequestInternal) -> GameUpdate:
+        """
+        Does the work of make_request, must be called with self._lock held.
+        """
+        tick = request.target_tick
+        ticks = self._req_ticks
+        reqs = self._req_list
+        valid = self._req_valid
+
+        # 1: Start from the latest cached State at or before the target tick, replaying whatever
+        #    is queued between that State and the target tick.
+        end = bisect_right(ticks, tick)
+        start = end
+        while start > 0 and ticks[start-1] not in self._tick_snapshots:
+            start -= 1
+        if end == len(ticks):
+            # Nothing is queued after the target tick, which is the usual case for requests
+            # targeting the near future. The latest State is already at hand.
+            current_state = self._head_state
         else:
-            # The change is not applicable.
-            result.invalidates.append(request)
-            return result
-
-        # Continue applying requests. Anything that violates rules goes in the invalidate pile.
-        while time_i < times_len :
-            for req in self.requests[time_i]:
-                proposed_state = self._apply_request(current_state, req)
-                if proposed_state:
-                    current_state = proposed_state
-                else:
-                    result.invalidates.append(req)
+            current_state = self._tick_snapshots[ticks[start-1]] if start > 0 else self.state
 
-            time_i = time_i + 1
+            for i in range(start, end):
+                if valid[i]:
+                    current_state = self._apply_request(current_state, reqs[i])
 
-        return result
+        current_state = self._apply_request(current_state, request)
 
+        if current_state is None:
+            # The change is not applicable.
+            return GameUpdate.model_construct(new=[], invalidates=[request.source])
+
+        ticks.insert(end, tick)
+        reqs.insert(end, request)
+        valid.insert(end, 1)
+        replayed = self._store_snapshot(tick, current_state, end - start + 1)
+
+        last = len(reqs) - 1
+        target = request.operation_target
+        if end < last and target and all(reqs[i].operation_target not in (None, target)
+                                         for i in range(end+1, last+1) if valid[i]):
+            # Fast path: Everything queued after the request works on other GameObjects, so none
+            # of it can be invalidated and it doesn't matter which comes first. Applying just the
+            # new request to the later States gives what replaying all of them would.
+            for time, snapshot in self._tick_snapshots.items():
+                if time > tick:
+                    self._tick_snapshots[time] = self._apply_request(snapshot, request)
+            self._head_state = self._apply_request(self._head_state, request)
+            return GameUpdate.model_construct(new=[request.source], invalidates=[])
+
+        # 2: Continue applying requests a tick at a time, refreshing the cached State at the end
+        #    of every later tick. Anything that violates rules gets its valid byte cleared.
+        first = end + 1
+        invalidates = []
+        yielded = first
+        while first <= last:
+            stop = bisect_right(ticks, ticks[first], first)
+            current_state = self._apply_tick(current_state, first, stop, invalidates)
+            replayed = self._store_snapshot(ticks[first], current_state, replayed + stop - first)
+            first = stop
+
+            if first - yielded >= 64:
+                # Don't hold up the event loop for the whole replay.
+                await asyncio.sleep(0)
+                yielded = first
+
+        self._head_state = current_state
+
+        # Everything in here is already validated, skip doing it again.
+        return GameUpdate.model_construct(new=[request.source], invalidates=invalidates)
+
+
+
+    def _apply_tick(self, state : State, first : int, stop : int, invalidates : list[GameRequest]) -> State:
+        """
+        Applies the valid queued requests in rows [first, stop), which all share a tick, and returns
+        the resulting State. Requests violating in-game rules get marked invalid and appended to
+        invalidates.
+        """
+        reqs = self._req_list
+        valid = self._req_valid
+        rows = [i for i in range(first, stop) if valid[i]]
+        targets = {reqs[i].operation_target for i in rows}
+
+        if len(rows) < 2 or None in targets or len(targets) != len(rows):
+            for i in rows:
+                proposed_state = self._apply_request(state, reqs[i])
+                if proposed_state is None:
+                    valid[i] = 0
+                    invalidates.append(reqs[i].source)
+                else:
+                    state = proposed_state
+            return state
+
+        # Every request works on a GameObject of its own, so they can't affect each other. Run all
+        # of them against the same State and put the replacements in a single new State.
+        replacements = {}
+        for i in rows:
+            new_obj = self._apply_object_operation(state, reqs[i])
+            if new_obj is None:
+                valid[i] = 0
+                invalidates.append(reqs[i].source)
+            else:
+                replacements[reqs[i].operation_target] = new_obj
+
+        if not replacements:
+            return state
+        return replace(state, objects={**state.objects, **replacements})
+
+    def _store_snapshot(self, tick : int, state : State, replayed : int) -> int:
+        """
+        Caches the State of a tick if at least SNAPSHOT_INTERVAL requests were replayed to get to it
+        from the last cached State, otherwise drops the tick's outdated snapshot. Returns how many
+        requests have been replayed since the last cached State.
+        """
+        if replayed >= Game.SNAPSHOT_INTERVAL:
+            self._tick_snapshots[tick] = state
+            return 0
 
+        self._tick_snapshots.pop(tick, None)
+        return replayed
 
-    def _apply_request(self, state: State, request : GameRequest) -> State:
+    def _apply_request(self, state: State, request : GameRequestInternal) -> State:
         """
         Apply the Request to this State, return the resulting State. If the request violates any
         in-game rules, None will be returned.
         """
         # 1. If there is a target_id, you arent supposed to handle this. Call target's operation
         #   instead.
-        if request.target_id:
-            game_obj = state.objects[request.target_id]
-            return game_obj.operations[request.operation](state, request)
-        
+        if request.operation_target:
+            new_obj = self._apply_object_operation(state, request)
+            if new_obj is None:
+                return None
+            return replace(state, objects={**state.objects, request.operation_target: new_obj})
+
         # 2. If its an operation concerning the game itself then it should be handled here
-        # ==== GameOperations concerning the game itself start here ====
-
-        # Operation start_game: starts the game.
-        if request.operation == "start_game":
-            if state.users[request.user_id].role == User.Role.LEADER:
-                new_state = deepcopy(state)
-                new_state.game_phase = Game.Phase.PLANNING
-                return new_state
+        operation = self.operations.get(request.operation)
+        if operation is None:
+            return None
+        return operation(state, request)
+
+    @staticmethod
+    def _apply_object_operation(state: State, request : GameRequestInternal) -> Optional[GameObject]:
+        """
+        Calls the operation of the request's target object. Returns the object replacing the target,
+        or None if the request violates any in-game rules.
+        """
+        target = state.objects.get(request.operation_target)
+        if target is None:
             return None
+        operation = target.operations.get(request.operation)
+        if operation is None:
+            return None
+        return operation(state, request)
+
+    # ==== GameOperations concerning the game itself start here ====
+
+    def _op_start_game(self, state: State, request : GameRequestInternal) -> Optional[State]:
+        """
+        Operation start_game: starts the game.
+        """
+        if state.users[request.user_id].role == ROLE_LEADER:
+            return replace(state, _phase_sprint=(state._phase_sprint & ~PHASE_MASK) | PHASE_PLANNING)
+        return None
 
-        # TODO Operation: add_user
-        # TODO Operation: end_game
-        # TODO Probably more Operations
+    # TODO Operation: add_user
+    # TODO Operation: end_game
+    # TODO Probably more Operations
 
 class Task(GameObject):
     """
@@ -205,74 +435,75 @@ class Task(GameObject):
         COMPLEX = 3
         CHAOTIC = 4
 
+    __slots__ = ('task_type', 'length', 'cur_tokens', 'max_tokens')
+
     def __init__(self, object_id : int,  task_type: Type, length : int):
         super().__init__(object_id)
         self.task_type = task_type
         self.length = length
+        self.cur_tokens : int = 0
+        self.max_tokens : int = length  # a task takes length tokens to finish.
+        self.operations = {OP_ADD_TOKEN: self._gop_add_token}
 
-    def _gop_add_token(self, state:Game.State, request: GameRequest)-> Game.State or None:
+    def _gop_add_token(self, state:Game.State, request: GameRequestInternal)-> Optional['Task']:
         """
         Adds a user's token to this task.
         """
-        if state.users[request.user_id].free_tokens == 0:
+        # Every check runs before anything gets copied, so rejecting the request allocates nothing.
+        # Copies share their operations with the Task they were copied from, so self may be an
+        # older version of the target. Game._apply_object_operation made sure the target exists.
+        target = state.objects[request.operation_target]
+        if target.cur_tokens >= target.max_tokens:
             return None
 
-        target = state.objects[request.target_id]
-        if not isinstance(target, Task):
-            raise ValueError("Given target_id doesnt belong to a task.")
-        if target.current_tokens == target.max_tokens:
+        user = state.users.get(request.user_id)
+        if user is None or user.free_tokens == 0:
             return None
 
-        new_state = deepcopy(state)
-        target = new_state.objects[request.target_id]
-        target.cur_tokens =target.cur_token + 1
-        return new_state
+        new_target = copy(target)
+        new_target.cur_tokens = target.cur_tokens + 1
+        return new_target
 
 class GameList:
     """
-    Contains a list of Games associated with the server.
+    Contains the Games associated with the server, in a fixed-size array of MAX_GAMES slots
+    indexed by game id. Free slots hold None.
     """
+    MAX_GAMES = 4096
+
     def __init__(self):
-        self.games = [ ]
-        self.free_indexes = [] # A heap containing previously freed indexes.
-        self.largest_index_in_use = 0
+        self.games : list[Optional[Game]] = [None] * GameList.MAX_GAMES
+        self._used = 0  # A bitset of the ids in use, bit i is set if id i is taken.
 
     def insert_game(self, game : Game) -> int:
         """
         Inserts a new Game into the GameList. Returns the id/index of the game in games.
         """
-        index = int()
-        if len(self.free_indexes) != 0:
-            # Use one of the previously freed indexes.
-            index = heapq.heappop(self.free_indexes)
-        else:
-            # No free indexes mean we gotta allocate a new one
-            index = len(self.games)
-            self.largest_index_in_use = index
-
-        self.games.insert(index, game)
+        # Adding 1 carries through the trailing set bits into the lowest unset one, so and-ing
+        # with the inverse leaves just the lowest free id's bit.
+        lowest_free = (self._used + 1) & ~self._used
+        index = lowest_free.bit_length() - 1
+        if index >= GameList.MAX_GAMES:
+            raise RuntimeError("GameList is full.")
+        self._used |= lowest_free
+
+        self.games[index] = game
         return index
 
-    def free_game(self, index : int) -> None:
+    def get_game(self, index : int) -> Optional[Game]:
         """
-        Removes the game by the given id/index from the list, and frees its slot.
+        Returns the game by the given id/index, or None if there is no such game.
         """
-        # 1: If the index isn't the rightmost one,
-        #    it cannot expose a None sequence.
-        #    Just remove, push it as freed and exit.
-        if index != self.largest_index_in_use:
-            self.games[index] = None
-            heapq.heappush(self.games, index)
-            return
-
-        # If we are here, it means we are about to remove the tail of the array.
-        # we need to check and clean any neighboring free slots from the games array.
-
-        # 2 : Remove trailing None sequence from the games array.
-        i = index-1
-        while(i>0 and (i in self.free_indexes)):
-            self.free_indexes.pop(i)
-            i -= 1
-
-        del self.games[i+1:]
+        # Negative ids would otherwise index from the end of games.
+        if 0 <= index < GameList.MAX_GAMES:
+            return self.games[index]
+        return None
 
+    def free_game(self, index : int) -> None:
+        """
+        Removes the game by the given id/index from the list, and frees its id.
+        """
+        if not 0 <= index < GameList.MAX_GAMES:
+            raise IndexError("No game with id {}.".format(index))
+        self.games[index] = None
+        self._used &= ~(1 << index)
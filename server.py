@@ -1,83 +1,171 @@
-import os
+import asyncio
+import hashlib
+from pathlib import Path
 
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect, status
+from fastapi.responses import HTMLResponse, RedirectResponse, Response
 from jinja2 import Environment as JnEnv, FileSystemLoader as JnFileSystemLoader, select_autoescape
-import random
+from jinja2 import FileSystemBytecodeCache as JnFileSystemBytecodeCache
+from pydantic import ValidationError
+import secrets
 from game import *
 
 
 app = FastAPI()
 
+TEMPLATES_DIR = Path(__file__).resolve().parent / 'templates'
+
 jinja_env = JnEnv(
-                    loader=JnFileSystemLoader(f'{os.path.dirname(__file__)}/templates/'),
-                    autoescape=select_autoescape('html')
+                    loader=JnFileSystemLoader(str(TEMPLATES_DIR)),
+                    autoescape=select_autoescape('html'),
+                    # Templates are loaded once at startup, so there is nothing to reload. The
+                    # bytecode cache lets restarted workers skip compiling them again.
+                    auto_reload=False,
+                    bytecode_cache=JnFileSystemBytecodeCache()
                  )
 GameList = GameList()
+game_sockets : dict[int, set[WebSocket]] = {}   # The websockets connected to each game.
+
+# GameUpdates echo whole GameRequests, the authcodes in them must never leave the server.
+_UPDATE_EXCLUDE = {'new': {'__all__': {'user_authcode'}}, 'invalidates': {'__all__': {'user_authcode'}}}
+
+INDEX_TMPL = jinja_env.get_template(name='index.html')
+TUTORIAL_TMPL = jinja_env.get_template(name='tutorial1.html')
+LOBBY_TMPL = jinja_env.get_template(name='lobby.html')
+
+# index.html and tutorial1.html don't take any context, so they only need to be rendered and
+# encoded once. Browsers revalidate them with their ETag.
+_INDEX_BYTES = INDEX_TMPL.render().encode('utf-8')
+_TUTORIAL_BYTES = TUTORIAL_TMPL.render().encode('utf-8')
+_INDEX_ETAG = '"{}"'.format(hashlib.sha1(_INDEX_BYTES).hexdigest())
+_TUTORIAL_ETAG = '"{}"'.format(hashlib.sha1(_TUTORIAL_BYTES).hexdigest())
+
+
+def _static_page(request : Request, body : bytes, etag : str) -> Response:
+    """
+    Returns a pre-rendered page, or an empty 304 if the client already has this version of it.
+    """
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type='text/html', headers=headers)
 
 
 @app.get('/', response_class=HTMLResponse)
-def get_homepage():
+async def get_homepage(request : Request):
     """
     Returns the home page.
 
     Homepage has a single button, which redirects the user to /create_game in order to create
     the game.
     """
-    return jinja_env.get_template(name='index.html').render()
+    return _static_page(request, _INDEX_BYTES, _INDEX_ETAG)
 
 @app.get('/tutorial', response_class=HTMLResponse)
-def get_tutorial():
+async def get_tutorial(request : Request):
     """
     Returns the tutorial page.
     """
-    return jinja_env.get_template(name='tutorial1.html').render()
+    return _static_page(request, _TUTORIAL_BYTES, _TUTORIAL_ETAG)
 
 
 @app.get('/create_game', response_class=RedirectResponse)
-def create_game():
+async def create_game():
     """
     Creates a new Game object, then redirects user to /join/{room_id}.
+
+    If there is no room for another game, redirects to /?error=full
     """
     game1 = Game()
-    index = GameList.insert_game(game1)
+    try:
+        index = GameList.insert_game(game1)
+    except RuntimeError:
+        return RedirectResponse(url='/?error=full')
 
     return RedirectResponse(url=app.url_path_for("join_game",room_id=index))
 
 
 @app.get('/join/{room_id}')
-def join_game(room_id : int):
+async def join_game(room_id : int):
     """
     Registers a user to a game, then redirects user to /game/{room_id}.
 
     If game does not exist, redirects to /?invalidroom=1
     """
-    id = random.randint(9, 1000000000)
-    while id in GameList.games[room_id].state.users:
-        id = random.randint(9,1000000000)
-    user1 = User(id,'Player{}'.format(len(GameList.games[room_id].state.users)+1),random.randint(1000000,9999999))
-    GameList.games[room_id].add_user(user1)
+    game = GameList.get_game(room_id)
+    if game is None:
+        return RedirectResponse(url='/?invalidroom=1')
+    users = game.state.users
+    # Ids and authcodes are what requests get authenticated with, so they come from secrets.
+    id = secrets.randbelow(1000000000 - 8) + 9
+    while id in users:
+        id = secrets.randbelow(1000000000 - 8) + 9
+    user1 = User(id, 'Player{}'.format(len(users)+1), secrets.randbelow(9000000) + 1000000)
+    game.add_user(user1)
     return RedirectResponse(url=app.url_path_for("get_game", room_id=room_id))
 
 
 @app.get('/game/{room_id}', response_class=HTMLResponse)
-def get_game(room_id:int):
+async def get_game(room_id:int):
     """
     Returns the page with all the game stuff on it.
     user_id, user_authcode and room_id will be integrated into the page with a Jinja template.
 
     After being received, the page must connect to /game_ws/{room_id}/{user_id} to send and 
     receive game requests.
+
+    If game does not exist, redirects to /?invalidroom=1
     """
-    return jinja_env.get_template(name='lobby.html').render()
+    if GameList.get_game(room_id) is None:
+        return RedirectResponse(url='/?invalidroom=1')
+    return LOBBY_TMPL.render()
 
 
-@app.get('/game_ws/{room_id}/{user_id}')
-def game_ws(room_id:int , user_id:int):
+@app.websocket('/game_ws/{room_id}/{user_id}')
+async def game_ws(websocket : WebSocket, room_id:int , user_id:int, authcode:int):
     """
-    The websocket for user-game pair. Game requests come and leave from here. All game requests
-    must be sent with a user_authcode to validate that it is infact the user who sent the request.
+    The websocket for user-game pair, connected to as /game_ws/{room_id}/{user_id}?authcode=...
+    Game requests come and leave from here. All game requests must be sent with a user_authcode
+    to validate that it is infact the user who sent the request.
 
-    It basically is a middle man between the users and Game.make_request()
+    It basically is a middle man between the users and Game.make_request(). GameUpdates that
+    approve a request go out to every user connected to the game, a rejected request is only
+    reported back to its sender.
     """
-    pass
\ No newline at end of file
+    game = GameList.get_game(room_id)
+    if game is None or not game.is_authorized(user_id, authcode):
+        # Closing before accepting rejects the handshake, nothing gets set up for the room.
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    sockets = game_sockets.setdefault(room_id, set())
+    sockets.add(websocket)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message['type'] == 'websocket.disconnect':
+                return
+            # Parsed and validated straight from the raw message by pydantic-core, text and binary
+            # frames alike.
+            try:
+                request = GameRequest.model_validate_json(message.get('bytes') or message.get('text') or '')
+            except ValidationError:
+                await websocket.close(code=status.WS_1007_INVALID_FRAME_PAYLOAD_DATA)
+                return
+            if request.user_id != user_id or not game.is_authorized(user_id, request.user_authcode):
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                return
+            # Convert once here, the Game only ever works with the internal form.
+            update = await game.make_request(GameRequestInternal.from_request(request))
+            # Serialized straight to JSON by pydantic-core, skipping model_dump() and json.dumps,
+            # and only once no matter how many users it goes to.
+            payload = update.model_dump_json(exclude=_UPDATE_EXCLUDE)
+            if len(update.new) == 0:
+                await websocket.send_text(payload)
+            else:
+                # A user disconnecting mid-broadcast is handled by their own game_ws.
+                await asyncio.gather(*(ws.send_text(payload) for ws in sockets), return_exceptions=True)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sockets.discard(websocket)
\ No newline at end of file
@@ -0,0 +1,215 @@
+import random
+import unittest
+
+from game import *
+
+
+class ReplayReference:
+    """
+    The naive way of running a Game: every request made so far is replayed from the starting
+    State, in tick order, each time a new one comes in. Game.make_request must agree with it.
+    """
+    def __init__(self, game : Game):
+        self.game = game
+        self.start = game.state
+        self.live : list[GameRequestInternal] = []
+
+    def _replay(self, requests : list[GameRequestInternal]):
+        """
+        Replays the requests from the starting State. Returns the final State and the requests
+        that were rejected on the way.
+        """
+        state = self.start
+        rejected = []
+        for request in requests:
+            new_state = self.game._apply_request(state, request)
+            if new_state is None:
+                rejected.append(request)
+            else:
+                state = new_state
+        return state, rejected
+
+    def make_request(self, request : GameRequestInternal):
+        """
+        Returns the request_ids of the approved and invalidated requests, like a GameUpdate.
+        """
+        # Requests of the same tick keep the order they came in.
+        index = len(self.live)
+        while index > 0 and self.live[index - 1].target_tick > request.target_tick:
+            index -= 1
+        proposed = self.live[:index] + [request] + self.live[index:]
+
+        # The new request is rejected if it can't be applied on top of everything before it.
+        _, rejected = self._replay(proposed[:index + 1])
+        if any(r is request for r in rejected):
+            return [], [request.request_id]
+
+        _, rejected = self._replay(proposed)
+        self.live = [r for r in proposed if all(r is not x for x in rejected)]
+        return [request.request_id], [r.request_id for r in rejected]
+
+    def state(self) -> Game.State:
+        return self._replay(self.live)[0]
+
+
+def _signature(state : Game.State):
+    return state._phase_sprint, tuple(sorted((k, o.cur_tokens) for k, o in state.objects.items()))
+
+
+class MakeRequestTest(unittest.IsolatedAsyncioTestCase):
+    LEADER_ID = 1
+    USER_ID = 2
+    TASK_IDS = (1000, 1001, 1002)
+
+    def make_game(self, task_length : int = 3) -> Game:
+        game = Game()
+        for user_id in (self.LEADER_ID, self.USER_ID):
+            user = User(user_id, 'Player{}'.format(user_id), 1234567)
+            user.free_tokens = 3
+            if user_id == self.LEADER_ID:
+                user.role = ROLE_LEADER
+            game.add_user(user)
+        for task_id in self.TASK_IDS:
+            game.state.objects[task_id] = Task(task_id, Task.Type.SIMPLE, task_length)
+        return game
+
+    @staticmethod
+    def request(request_id : int, tick : int, operation : str = 'add_token',
+                target : Optional[int] = 1000, user_id : int = LEADER_ID) -> GameRequestInternal:
+        return GameRequestInternal.from_request(GameRequest(
+            user_id=user_id, user_authcode=1234567, request_id=request_id, target_tick=tick,
+            operation_target=target, operation=operation, operation_args={}))
+
+    async def check(self, game : Game, reference : ReplayReference, request : GameRequestInternal):
+        """
+        Makes the request on both the game and the reference, and compares the results.
+        """
+        update = await game.make_request(request)
+        new, invalidates = reference.make_request(request)
+        self.assertEqual([r.request_id for r in update.new], new)
+        self.assertEqual(sorted(r.request_id for r in update.invalidates), sorted(invalidates))
+        self.assertEqual(_signature(game._head_state), _signature(reference.state()))
+        return update
+
+    async def test_out_of_order_ticks(self):
+        game = self.make_game()
+        reference = ReplayReference(game)
+        updates = [await self.check(game, reference, self.request(request_id, tick))
+                   for request_id, tick in enumerate((5, 2, 9, 0, 5, 3))]
+        # Tick 0 fills the task before tick 9 gets to it.
+        self.assertEqual([r.request_id for r in updates[3].invalidates], [2])
+        # The task is already full at tick 5.
+        self.assertEqual(len(updates[4].new), 0)
+        # Tick 3 comes before the first tick 5 request, which no longer fits.
+        self.assertEqual([r.request_id for r in updates[5].invalidates], [0])
+
+    async def test_same_tick_batch(self):
+        game = self.make_game(task_length=2)
+        reference = ReplayReference(game)
+        requests = [self.request(0, 4, target=1000), self.request(1, 4, target=1001),
+                    self.request(2, 4, target=1000, user_id=self.USER_ID),
+                    self.request(3, 4, operation='start_game', target=None),
+                    self.request(4, 4, target=1000), self.request(5, 4, target=1002)]
+        for request in requests:
+            await self.check(game, reference, request)
+        self.assertEqual(game._head_state.objects[1000].cur_tokens, 2)
+        self.assertEqual(game._head_state.game_phase, PHASE_PLANNING)
+
+    async def test_earlier_request_invalidates_later_ones(self):
+        game = self.make_game(task_length=1)
+        reference = ReplayReference(game)
+        await self.check(game, reference, self.request(0, 8, target=1000))
+        await self.check(game, reference, self.request(1, 9, target=1001))
+        update = await self.check(game, reference, self.request(2, 3, target=1000))
+        self.assertEqual([r.request_id for r in update.new], [2])
+        self.assertEqual([r.request_id for r in update.invalidates], [0])
+
+    async def test_rejected_requests(self):
+        game = self.make_game()
+        reference = ReplayReference(game)
+        for request in (self.request(0, 1, target=999), self.request(1, 1, operation='fly'),
+                        self.request(2, 1, operation='start_game', target=None, user_id=self.USER_ID)):
+            update = await self.check(game, reference, request)
+            self.assertEqual(len(update.new), 0)
+            self.assertEqual(update.invalidates, [request.source])
+
+    async def test_skipped_snapshots(self):
+        game = self.make_game(task_length=100)
+        reference = ReplayReference(game)
+        for request_id in range(40):
+            await self.check(game, reference, self.request(request_id, request_id * 2))
+        # One request per tick, only every SNAPSHOT_INTERVAL'th tick is cached.
+        self.assertEqual(len(game._tick_snapshots), 40 // Game.SNAPSHOT_INTERVAL)
+
+        # Requests landing between cached ticks get replayed from an earlier snapshot, and the
+        # ones after them from there on. Same target, so the fast path doesn't apply.
+        for request_id, tick in enumerate((3, 17, 1, 41, 60), 40):
+            await self.check(game, reference, self.request(request_id, tick))
+        for tick, snapshot in game._tick_snapshots.items():
+            expected = ReplayReference(game)
+            expected.live = [r for r in reference.live if r.target_tick <= tick]
+            self.assertEqual(_signature(snapshot), _signature(expected.state()))
+
+    async def test_random_requests(self):
+        rng = random.Random(411)
+        for _ in range(20):
+            game = self.make_game()
+            reference = ReplayReference(game)
+            for request_id in range(60):
+                if rng.random() < 0.25:
+                    request = self.request(request_id, rng.randint(0, 20), operation='start_game',
+                                           target=None, user_id=rng.choice((self.LEADER_ID, self.USER_ID)))
+                else:
+                    request = self.request(request_id, rng.randint(0, 20), target=rng.choice(self.TASK_IDS),
+                                           user_id=rng.choice((self.LEADER_ID, self.USER_ID)))
+                await self.check(game, reference, request)
+
+
+class GameListTest(unittest.TestCase):
+    def test_lowest_free_id_reused(self):
+        games = GameList()
+        self.assertEqual([games.insert_game(Game()) for _ in range(4)], [0, 1, 2, 3])
+        games.free_game(2)
+        games.free_game(0)
+        self.assertIsNone(games.get_game(0))
+        self.assertEqual(games.insert_game(Game()), 0)
+        self.assertEqual(games.insert_game(Game()), 2)
+        self.assertEqual(games.insert_game(Game()), 4)
+
+    def test_full(self):
+        games = GameList()
+        for _ in range(GameList.MAX_GAMES):
+            games.insert_game(Game())
+        with self.assertRaises(RuntimeError):
+            games.insert_game(Game())
+        games.free_game(100)
+        self.assertEqual(games.insert_game(Game()), 100)
+
+    def test_out_of_range_ids(self):
+        games = GameList()
+        for _ in range(GameList.MAX_GAMES):
+            games.insert_game(Game())
+        for index in (-1, GameList.MAX_GAMES):
+            self.assertIsNone(games.get_game(index))
+            with self.assertRaises(IndexError):
+                games.free_game(index)
+        # Nothing got freed by the failed calls.
+        self.assertIsNotNone(games.get_game(GameList.MAX_GAMES - 1))
+        with self.assertRaises(RuntimeError):
+            games.insert_game(Game())
+
+
+class IsAuthorizedTest(unittest.TestCase):
+    def test_is_authorized(self):
+        game = Game()
+        game.add_user(User(11, 'Player1', 1111111))
+        game.add_user(User(12, 'Player2', 2222222))
+        self.assertTrue(game.is_authorized(11, 1111111))
+        self.assertTrue(game.is_authorized(12, 2222222))
+        self.assertFalse(game.is_authorized(11, 2222222))
+        self.assertFalse(game.is_authorized(13, 1111111))
+        self.assertFalse(game.is_authorized(11, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
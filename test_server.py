@@ -0,0 +1,121 @@
+import json
+import unittest
+
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import server
+from game import *
+
+
+class GameWebsocketTest(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(server.app)
+        self.room_id = server.GameList.insert_game(Game())
+        self.addCleanup(server.GameList.free_game, self.room_id)
+        self.game = server.GameList.get_game(self.room_id)
+        self.leader = User(11, 'Player1', 1111111)
+        self.leader.role = ROLE_LEADER
+        self.user = User(12, 'Player2', 2222222)
+        self.game.add_user(self.leader)
+        self.game.add_user(self.user)
+
+    def connect(self, user : User, authcode : Optional[int] = None):
+        return self.client.websocket_connect('/game_ws/{}/{}?authcode={}'.format(
+            self.room_id, user.user_id, user.authcode if authcode is None else authcode))
+
+    def start_game(self, user : User, request_id : int = 1) -> dict:
+        return dict(user_id=user.user_id, user_authcode=user.authcode, request_id=request_id,
+                    target_tick=1, operation='start_game', operation_args={})
+
+    def test_update_reaches_passive_sockets(self):
+        with self.connect(self.user) as passive, self.connect(self.leader) as leader:
+            leader.send_json(self.start_game(self.leader))
+            sent = leader.receive_text()
+            received = passive.receive_text()
+        self.assertEqual(sent, received)
+        self.assertEqual([r['request_id'] for r in _parse_update(sent)['new']], [1])
+
+    def test_authcodes_never_sent(self):
+        with self.connect(self.user) as user, self.connect(self.leader) as leader:
+            leader.send_json(self.start_game(self.leader, 1))
+            frames = [leader.receive_text(), user.receive_text()]
+            # Only the leader may start the game. Rejected requests go back to their sender alone.
+            user.send_json(self.start_game(self.user, 2))
+            frames.append(user.receive_text())
+        self.assertEqual(len(_parse_update(frames[2])['invalidates']), 1)
+        for frame in frames:
+            self.assertNotIn('user_authcode', frame)
+            self.assertNotIn(str(self.leader.authcode), frame)
+            self.assertNotIn(str(self.user.authcode), frame)
+
+    def test_binary_frames(self):
+        with self.connect(self.leader) as leader:
+            leader.send_bytes(json.dumps(self.start_game(self.leader)).encode('utf-8'))
+            update = _parse_update(leader.receive_text())
+        self.assertEqual([r['request_id'] for r in update['new']], [1])
+
+    def test_malformed_frames_rejected(self):
+        for frame in ('{"garbage": 1}', b'\xff\xfe', b''):
+            with self.assertRaises(WebSocketDisconnect) as cm:
+                with self.connect(self.leader) as leader:
+                    if isinstance(frame, str):
+                        leader.send_text(frame)
+                    else:
+                        leader.send_bytes(frame)
+                    leader.receive_text()
+            self.assertEqual(cm.exception.code, 1007)
+
+    def test_wrong_authcode_rejected(self):
+        with self.assertRaises(WebSocketDisconnect) as cm:
+            with self.connect(self.user, authcode=self.leader.authcode) as ws:
+                ws.receive_text()
+        self.assertEqual(cm.exception.code, 1008)
+        self.assertFalse(server.game_sockets.get(self.room_id))
+
+
+class PagesTest(unittest.TestCase):
+    def setUp(self):
+        self.client = TestClient(server.app)
+
+    def test_etag(self):
+        for url in ('/', '/tutorial'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers['etag']
+            cached = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(cached.status_code, 304)
+            self.assertEqual(cached.content, b'')
+            self.assertEqual(cached.headers['etag'], etag)
+            stale = self.client.get(url, headers={'If-None-Match': '"stale"'})
+            self.assertEqual(stale.status_code, 200)
+            self.assertEqual(stale.content, response.content)
+
+    def test_invalid_rooms(self):
+        room_id = server.GameList.insert_game(Game())
+        server.GameList.free_game(room_id)
+        for bad_id in (room_id, -1, GameList.MAX_GAMES):
+            for url in ('/join/{}', '/game/{}'):
+                response = self.client.get(url.format(bad_id), follow_redirects=False)
+                self.assertEqual(response.headers['location'], '/?invalidroom=1')
+            with self.assertRaises(WebSocketDisconnect) as cm:
+                with self.client.websocket_connect('/game_ws/{}/11?authcode=1111111'.format(bad_id)) as ws:
+                    ws.receive_text()
+            self.assertEqual(cm.exception.code, 1008)
+            self.assertFalse(server.game_sockets.get(bad_id))
+
+    def test_join(self):
+        response = self.client.get('/create_game', follow_redirects=False)
+        room_id = int(response.headers['location'].rsplit('/', 1)[1])
+        self.addCleanup(server.GameList.free_game, room_id)
+        response = self.client.get('/join/{}'.format(room_id), follow_redirects=False)
+        self.assertEqual(response.headers['location'], '/game/{}'.format(room_id))
+        self.assertEqual(len(server.GameList.get_game(room_id).state.users), 1)
+
+
+def _parse_update(frame : str) -> dict:
+    return GameUpdate.model_validate_json(frame).model_dump()
+
+
+if __name__ == '__main__':
+    unittest.main()